@@ -1,80 +1,169 @@
 #!/usr/bin/env python3
 
+import functools
 import os
-import pickle
-import select
+import selectors
 import shutil
 import socket
+import struct
 import sys
-import time
 from typing import Optional
 
-from server import Color, Game, GenericDisplay, Grid, Player  # noqa: F401
-
+from server import (  # noqa: F401
+    FRAME_HEADER,
+    PALETTE,
+    SNAPSHOT,
+    Color,
+    Game,
+    GenericDisplay,
+    Grid,
+    Player,
+)
 
 if os.name == 'nt':
     import msvcrt
 
-    def get_key() -> Optional[str]:
+    def get_keys() -> list[bytes]:
         if msvcrt.kbhit():
             msvcrt.getch()
             c = msvcrt.getch()
             vals = [72, 77, 80, 75]
             key = vals.index(ord(c.decode('utf-8')))
             # TODO: use Key enum from server
-            return {0: 'UP', 1: 'RIGHT', 2: 'DOWN', 3: 'LEFT'}[key]
-        return None
+            return [{0: b'UP', 1: b'RIGHT', 2: b'DOWN', 3: b'LEFT'}[key]]
+        return []
 else:
     import termios
     import tty
 
-    def get_key() -> Optional[str]:
-        dr, _, _ = select.select([sys.stdin], [], [], 0)
-        if dr:
-            ch = sys.stdin.read(1)
-            if ch == '\033':
-                ch += sys.stdin.read(2)
-                if ch == '\033[A':
-                    return 'UP'
-                elif ch == '\033[B':
-                    return 'DOWN'
-                elif ch == '\033[C':
-                    return 'RIGHT'
-                elif ch == '\033[D':
-                    return 'LEFT'
-            return ch
-        return None
+    ARROW_KEYS = {
+        b'\033[A': b'UP',
+        b'\033[B': b'DOWN',
+        b'\033[C': b'RIGHT',
+        b'\033[D': b'LEFT',
+    }
+
+    # Reads the raw descriptor: sys.stdin would buffer keys where the
+    # selector cannot see them
+    def get_keys() -> list[bytes]:
+        data = os.read(sys.stdin.fileno(), 1024)
+        keys = []
+        i = 0
+        while i < len(data):
+            key = ARROW_KEYS.get(data[i : i + 3])
+            if key:
+                keys.append(key)
+                i += 3
+            else:
+                keys.append(data[i : i + 1])
+                i += 1
+        return keys
+
+
+# Pops every complete frame off the front of buf, leaving any partial tail
+def split_frames(buf: bytearray) -> list[bytearray]:
+    frames = []
+    offset = 0
+    while len(buf) - offset >= FRAME_HEADER.size:
+        (size,) = FRAME_HEADER.unpack_from(buf, offset)
+        start = offset + FRAME_HEADER.size
+        if len(buf) - start < size:
+            break
+        frames.append(buf[start : start + size])
+        offset = start + size
+    del buf[:offset]
+    return frames
+
+
+@functools.cache
+def sgr_background(color: Color) -> bytes:
+    return b'\033[48;2;%d;%d;%dm' % (
+        int(color.r * 255),
+        int(color.g * 255),
+        int(color.b * 255),
+    )
+
+
+RESET = b'\033[0m'
+
+# Marks a cell that has never been drawn, so it always differs on the first frame
+UNDRAWN = 0xFF
 
 
 class Display(GenericDisplay):
     width: int
     height: int
-    buffer: list[Color]
+    buffer: bytearray
+    prev_buffer: bytearray
+    palette: dict[Color, int]
+    sgr: list[bytes]
 
     def __init__(self, width: int, height: int) -> None:
         self.width = width
         self.height = height
-        self.buffer = [Color.default() for _ in range(width * height)]
+        self.buffer = bytearray(width * height)
+        self.prev_buffer = bytearray([UNDRAWN]) * (width * height)
+        # Grid colors keep their wire indices; others are appended on use
+        self.palette = {color: i for i, color in enumerate(PALETTE)}
+        self.sgr = [sgr_background(color) for color in PALETTE]
+
+    def color_index(self, color: Color) -> int:
+        index = self.palette.get(color)
+        if index is None:
+            index = len(self.sgr)
+            assert index < UNDRAWN, 'display palette is full'
+            self.palette[color] = index
+            self.sgr.append(sgr_background(color))
+        return index
 
     def draw(self, x: int, y: int, color: Color) -> None:
-        if 0 <= x < self.width and 0 <= y < self.height:
-            self.buffer[y * self.width + x] = color
-
-    def render(self) -> str:
-        rows = []
+        self.draw_span(x, y, 1, color)
+
+    def draw_span(self, x: int, y: int, length: int, color: Color) -> None:
+        start = max(x, 0)
+        end = min(x + length, self.width)
+        if start < end and 0 <= y < self.height:
+            offset = y * self.width
+            index = self.color_index(color)
+            self.buffer[offset + start : offset + end] = bytes([index]) * (end - start)
+
+    def render(self) -> None:
+        out = bytearray()
+        current = UNDRAWN
         for y in range(self.height):
-            row = ''
-            for x in range(self.width):
-                color = self.buffer[y * self.width + x]
-                from math import floor
-
-                row += '\033[48;2;%d;%d;%dm ' % (
-                    floor(color.r * 255),
-                    floor(color.g * 255),
-                    floor(color.b * 255),
-                )
-            rows.append(row)
-        sys.stdout.write('\033[H' + '\n'.join(rows))
+            start = y * self.width
+            end = start + self.width
+            if self.buffer[start:end] == self.prev_buffer[start:end]:
+                continue
+            cursor = -1
+            x = 0
+            while x < self.width:
+                i = start + x
+                if self.buffer[i] == self.prev_buffer[i]:
+                    x += 1
+                    continue
+                if cursor >= 0:
+                    out += b'\033[%dC' % (x - cursor) if x - cursor > 1 else b'\033[C'
+                elif x == 0:
+                    out += b'\033[%dH' % (y + 1)
+                else:
+                    out += b'\033[%d;%dH' % (y + 1, x + 1)
+                while x < self.width and self.buffer[i] != self.prev_buffer[i]:
+                    index = self.buffer[i]
+                    if index != current:
+                        out += self.sgr[index]
+                        current = index
+                    out += b' '
+                    x += 1
+                    i += 1
+                cursor = x
+            self.prev_buffer[start:end] = self.buffer[start:end]
+        if not out:
+            return
+        out += RESET
+        view = memoryview(out)
+        while view:
+            view = view[os.write(sys.stdout.fileno(), view) :]
 
 
 def main() -> None:
@@ -94,35 +183,52 @@ def main() -> None:
     term_size = shutil.get_terminal_size()
     display = Display(term_size.columns, term_size.lines)
 
+    rx_buf = bytearray()
+    game: Optional[Game] = None
+    sel = selectors.DefaultSelector()
+    sel.register(sock, selectors.EVENT_READ)
+    if os.name != 'nt':
+        sel.register(sys.stdin, selectors.EVENT_READ)
+
     try:
         while True:
-            key = get_key()
-            if key:
-                try:
-                    sock.sendall(key.encode())
-                except Exception as e:
-                    print('[ERROR] Unable to send data: %s' % e, file=sys.stderr)
-                    exit(1)
-
-            rlist, _, _ = select.select([sock], [], [], 0.05)
-            if sock in rlist:
+            ready = [key.fileobj for key, _ in sel.select(timeout=0.05)]
+            if os.name == 'nt' or sys.stdin in ready:
+                for key in get_keys():
+                    try:
+                        sock.sendall(key + b'\n')
+                    except Exception as e:
+                        print('[ERROR] Unable to send data: %s' % e, file=sys.stderr)
+                        exit(1)
+
+            if sock in ready:
                 data = sock.recv(65536)
                 if not data:
                     break
+                rx_buf += data
+                frames = split_frames(rx_buf)
+                if not frames:
+                    continue
                 try:
-                    game = pickle.loads(data)
+                    for frame in frames:
+                        if not frame:
+                            raise ValueError('empty frame')
+                        if frame[0] == SNAPSHOT:
+                            game = Game.decode(frame)
+                        elif game is not None:
+                            game.apply_delta(frame)
+                except (struct.error, ValueError) as e:
+                    print('[ERROR] Failed to decode data: %s' % e, file=sys.stderr)
+                    exit(1)
+                if game is not None:
                     game.render(display)
                     display.render()
-                except (pickle.UnpicklingError, EOFError) as e: 
-                    print('[ERROR] Failed to unpickle data: %s' % e, file=sys.stderr)
-                    exit(1)
-
-            time.sleep(0.01)
     except KeyboardInterrupt:
         pass
     finally:
         if os.name != 'nt':
             termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
+        sel.close()
         sock.close()
 
 
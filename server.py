@@ -1,22 +1,42 @@
 #!/usr/bin/env python3
 
-import math
-import pickle
+import array
+import asyncio
+import functools
 import random
-import select
+import re
 import shutil
-import socket
+import struct
 import sys
-import threading
 import time
 from abc import ABC, abstractmethod
-from collections import deque
 from dataclasses import dataclass, field
 from enum import Enum, auto
-from typing import Any, Optional
+from typing import Optional
 
 TARGET_FPS = 20
 PLAYER_SPEED = 4
+SEND_BUFFER_LIMIT = 1 << 20
+
+# Every message on the wire is a big-endian u32 length followed by the payload
+FRAME_HEADER = struct.Struct('>I')
+
+# A client gets one snapshot when it joins and a delta on every tick after
+SNAPSHOT = 0
+DELTA = 1
+SNAPSHOT_HEADER = struct.Struct('>BHHH')  # kind, width, height, player count
+DELTA_HEADER = struct.Struct('>BIH')  # kind, ops byte length, player count
+PLAYER_STATE = struct.Struct('>HHB')
+
+# Grid operations carried by a delta, replayed by the client in order. Fills
+# are sent as a single opcode and recomputed client-side from the same grid
+OP_SET = 0
+OP_FILL = 1
+OP_CLEAR = 2
+SET_OP = struct.Struct('>BIB')  # op, cell index, color
+COLOR_OP = struct.Struct('>BB')  # op, color
+
+UNREACHED_RUN = re.compile(b'\x01+')
 
 
 class Key(Enum):
@@ -26,13 +46,14 @@ class Key(Enum):
     RIGHT = auto()
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Color:
     r: float
     g: float
     b: float
 
     @staticmethod
+    @functools.cache
     def default() -> 'Color':
         return Color(0, 0, 0)
 
@@ -40,14 +61,30 @@ class Color:
         return Color(self.r * factor, self.g * factor, self.b * factor)
 
 
+PALETTE = [
+    Color.default(),
+    Color(0, 0, 1),
+    Color(0, 1, 0),
+    Color(0, 1, 1),
+    Color(1, 0, 0),
+    Color(1, 0, 1),
+    Color(1, 1, 0),
+]
+HEAD_PALETTE = [color.brightness(0.5) for color in PALETTE]
+
+
 class GenericDisplay(ABC):
     width: int
     height: int
-    buffer: list[Color]
+    # Row-major color indices; indices below len(PALETTE) are PALETTE entries
+    buffer: bytearray
 
     @abstractmethod
     def draw(self, x: int, y: int, color: Color) -> None: ...
 
+    @abstractmethod
+    def draw_span(self, x: int, y: int, length: int, color: Color) -> None: ...
+
     @abstractmethod
     def render(self) -> None: ...
 
@@ -55,78 +92,116 @@ class GenericDisplay(ABC):
 class Grid:
     width: int
     height: int
-    cells: list[Color]
+    # Row-major PALETTE indices; 0 is the blank default color
+    cells: bytearray
 
     def __init__(self, width: int, height: int) -> None:
         self.width = width
         self.height = height
-        self.cells = [Color.default() for _ in range(width * height)]
+        self.cells = bytearray(width * height)
 
-    def get(self, x: int, y: int) -> Optional[Color]:
+    def get(self, x: int, y: int) -> Optional[int]:
         if 0 <= x < self.width and 0 <= y < self.height:
             return self.cells[y * self.width + x]
         return None
 
-    def set(self, x: int, y: int, color: Color) -> None:
+    def set(self, x: int, y: int, color: int) -> None:
         if 0 <= x < self.width and 0 <= y < self.height:
             self.cells[y * self.width + x] = color
 
+    def clear(self, color: int) -> None:
+        table = bytearray(range(256))
+        table[color] = 0
+        self.cells = self.cells.translate(table)
+
     def render(self, display: GenericDisplay) -> None:
-        for y in range(self.height):
-            for x in range(self.width * 2):
-                cell = self.get(x // 2, y)
-                assert cell
-                display.draw(x, y, cell)
-
-    def fill_enclosed_area(self, player_color: Color) -> None:
-        visited = [False] * (self.width * self.height)
-        queue: deque[tuple[int, int]] = deque()
-
-        for x in range(self.width):
-            for y in (0, self.height - 1):
-                cell = self.get(x, y)
-                if cell and cell != player_color and not visited[y * self.width + x]:
-                    visited[y * self.width + x] = True
-                    queue.append((x, y))
-        for y in range(self.height):
-            for x in (0, self.width - 1):
-                cell = self.get(x, y)
-                if cell and cell != player_color and not visited[y * self.width + x]:
-                    visited[y * self.width + x] = True
-                    queue.append((x, y))
-
-        while queue:
-            cx, cy = queue.popleft()
-            for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1)):
-                nx, ny = cx + dx, cy + dy
-                if 0 <= nx < self.width and 0 <= ny < self.height:
-                    cell = self.get(nx, ny)
-                    if (
-                        cell
-                        and (not visited[ny * self.width + nx])
-                        and cell != player_color
-                    ):
-                        visited[ny * self.width + nx] = True
-                        queue.append((nx, ny))
-
-        for y in range(self.height):
-            for x in range(self.width):
-                if not visited[y * self.width + x]:
-                    self.set(x, y, player_color)
-
-
-@dataclass
+        # Each grid cell is two terminal columns wide
+        width = self.width
+        columns = min(width * 2, display.width)
+        line = bytearray(width * 2)
+        clipped = memoryview(line)[:columns]
+        rows = min(self.height, display.height)
+        for start, offset in zip(
+            range(0, rows * width, width),
+            range(0, rows * display.width, display.width),
+        ):
+            row = self.cells[start : start + width]
+            line[0::2] = row
+            line[1::2] = row
+            display.buffer[offset : offset + columns] = clipped
+
+    def fill_enclosed_area(self, player_color: int) -> None:
+        width = self.width
+        size = width * self.height
+        # Cells not yet reached by a flood from the border; whatever is still
+        # open once it finishes is enclosed
+        table = bytearray([1]) * 256
+        table[player_color] = 0
+        open_cells = self.cells.translate(table)
+        stack: list[int] = []
+
+        last_row = size - width
+        for start, stop, step in (
+            (0, width, 1),
+            (last_row, size, 1),
+            (width, last_row, width),
+            (2 * width - 1, last_row, width),
+        ):
+            edge = open_cells[start:stop:step]
+            i = edge.find(1)
+            while i != -1:
+                stack.append(start + i * step)
+                i = edge.find(1, i + 1)
+
+        # Scanline flood: a seed closes the whole open span around it in its
+        # row with one slice write, then pushes a single seed per open run
+        # directly above and below that span
+        while stack:
+            i = stack.pop()
+            if not open_cells[i]:
+                continue
+            row = i - i % width
+            left = max(open_cells.rfind(0, row, i) + 1, row)
+            right = open_cells.find(0, i, row + width)
+            if right == -1:
+                right = row + width
+            open_cells[left:right] = bytes(right - left)
+            for above_or_below in (left - width, left + width):
+                if not 0 <= above_or_below < size:
+                    continue
+                end = above_or_below + right - left
+                j = open_cells.find(1, above_or_below, end)
+                while j != -1:
+                    stack.append(j)
+                    j = open_cells.find(0, j, end)
+                    if j == -1:
+                        break
+                    j = open_cells.find(1, j, end)
+
+        fill = bytes([player_color])
+        for run in UNREACHED_RUN.finditer(open_cells):
+            start, end = run.span()
+            self.cells[start:end] = fill * (end - start)
+
+
+@dataclass(slots=True)
 class Player:
-    x: float
-    y: float
-    color: Color
-    dx: float = 0
-    dy: float = 0
-    trail: list[tuple[int, int]] = field(default_factory=list)
+    x: int
+    y: int
+    color: int
+    dx: int = 0
+    dy: int = 0
+    # Fraction of a cell travelled since the last whole step
+    step: float = 0
+    # Flat cell indices, -1 for steps pushed against a wall
+    trail: array.array[int] = field(default_factory=lambda: array.array('i'))
 
     def update(self, frame_time: float) -> None:
-        self.x += self.dx * frame_time * PLAYER_SPEED
-        self.y += self.dy * frame_time * PLAYER_SPEED
+        self.step += frame_time * PLAYER_SPEED
+        while self.step >= 1:
+            self.x += self.dx
+            self.y += self.dy
+            self.step -= 1
 
     def handle_key(self, key: Key) -> None:
         if key == Key.UP:
@@ -139,121 +214,264 @@ class Player:
             self.dx, self.dy = 1, 0
 
     def grid_position(self) -> tuple[int, int]:
-        return (int(math.floor(self.x)), int(math.floor(self.y)))
+        return (self.x, self.y)
 
 
 class Game:
     def __init__(self, width: int, height: int) -> None:
         self.grid = Grid(width, height)
         self.players: dict[int, Player] = {}
-        self.lock = threading.Lock()
         self.running = True
+        # Grid operations since the last delta, already in wire format
+        self.changes = bytearray()
+        self.dirty = True
+
+    def encode_snapshot(self) -> bytearray:
+        size = self.grid.width * self.grid.height
+        data = bytearray(
+            SNAPSHOT_HEADER.size + size + PLAYER_STATE.size * len(self.players)
+        )
+        SNAPSHOT_HEADER.pack_into(
+            data, 0, SNAPSHOT, self.grid.width, self.grid.height, len(self.players)
+        )
+        offset = SNAPSHOT_HEADER.size
+        data[offset : offset + size] = self.grid.cells
+        self.pack_players(data, offset + size)
+        return data
+
+    def encode_delta(self) -> bytearray:
+        ops, self.changes = self.changes, bytearray()
+        self.dirty = False
+        data = bytearray(
+            DELTA_HEADER.size + len(ops) + PLAYER_STATE.size * len(self.players)
+        )
+        DELTA_HEADER.pack_into(data, 0, DELTA, len(ops), len(self.players))
+        offset = DELTA_HEADER.size
+        data[offset : offset + len(ops)] = ops
+        self.pack_players(data, offset + len(ops))
+        return data
+
+    def pack_players(self, data: bytearray, offset: int) -> None:
+        for player in self.players.values():
+            PLAYER_STATE.pack_into(data, offset, player.x, player.y, player.color)
+            offset += PLAYER_STATE.size
+
+    def unpack_players(self, data: bytearray, offset: int, count: int) -> None:
+        self.players = {}
+        for player_id in range(count):
+            x, y, color = PLAYER_STATE.unpack_from(data, offset)
+            if color >= len(PALETTE):
+                raise ValueError('invalid player color')
+            self.players[player_id] = Player(x, y, color)
+            offset += PLAYER_STATE.size
 
-    def __getstate__(self) -> Any:
-        return (self.grid, self.players)
-
-    def __setstate__(self, state: Any) -> None:
-        self.grid, self.players = state
+    @staticmethod
+    def decode(data: bytearray) -> 'Game':
+        kind, width, height, player_count = SNAPSHOT_HEADER.unpack_from(data)
+        if kind != SNAPSHOT:
+            raise ValueError('not a snapshot')
+        game = Game(width, height)
+        offset = SNAPSHOT_HEADER.size
+        game.grid.cells = data[offset : offset + width * height]
+        if len(game.grid.cells) != width * height:
+            raise ValueError('truncated grid')
+        if max(game.grid.cells, default=0) >= len(PALETTE):
+            raise ValueError('invalid grid color')
+        game.unpack_players(data, offset + width * height, player_count)
+        return game
+
+    def apply_delta(self, data: bytearray) -> None:
+        kind, ops_size, player_count = DELTA_HEADER.unpack_from(data)
+        if kind != DELTA:
+            raise ValueError('not a delta')
+        offset = DELTA_HEADER.size
+        end = offset + ops_size
+        if end > len(data):
+            raise ValueError('truncated delta')
+        while offset < end:
+            op = data[offset]
+            if op == OP_SET:
+                _, index, color = SET_OP.unpack_from(data, offset)
+                if index >= len(self.grid.cells) or color >= len(PALETTE):
+                    raise ValueError('invalid cell update')
+                self.grid.cells[index] = color
+                offset += SET_OP.size
+                continue
+            _, color = COLOR_OP.unpack_from(data, offset)
+            if color >= len(PALETTE):
+                raise ValueError('invalid grid color')
+            if op == OP_FILL:
+                self.grid.fill_enclosed_area(color)
+            elif op == OP_CLEAR:
+                self.grid.clear(color)
+            else:
+                raise ValueError('unknown grid operation %d' % op)
+            offset += COLOR_OP.size
+        self.unpack_players(data, end, player_count)
 
     def add_player(self, player_id: int, player: Player) -> None:
-        with self.lock:
-            self.players[player_id] = player
+        self.players[player_id] = player
+        self.dirty = True
 
     def remove_player(self, player_id: int) -> None:
-        with self.lock:
-            if player_id in self.players:
-                for i, cell in enumerate(self.grid.cells):
-                    if cell == self.players[player_id].color:
-                        self.grid.cells[i] = Color.default()
-                del self.players[player_id]
+        if player_id in self.players:
+            color = self.players[player_id].color
+            self.grid.clear(color)
+            self.changes += COLOR_OP.pack(OP_CLEAR, color)
+            del self.players[player_id]
+            self.dirty = True
 
     def update(self, frame_time: float) -> None:
-        with self.lock:
-            for player in self.players.values():
-                player.update(frame_time)
-                new_x, new_y = player.grid_position()
-                if new_x < 0:
-                    player.x = 0
-                if new_x >= self.grid.width:
-                    player.x = self.grid.width - 1
-                if new_y < 0:
-                    player.y = 0
-                if new_y >= self.grid.height:
-                    player.y = self.grid.height - 1
-
-                cell = self.grid.get(new_x, new_y)
-                if cell and cell == player.color:
-                    if player.trail:
-                        self.grid.fill_enclosed_area(player.color)
-                        player.trail = []
-                else:
-                    player.trail.append((new_x, new_y))
-                    self.grid.set(new_x, new_y, player.color)
+        grid = self.grid
+        for player in self.players.values():
+            old_position = player.grid_position()
+            player.update(frame_time)
+            new_x, new_y = player.x, player.y
+            if new_x < 0:
+                player.x = 0
+            if new_x >= grid.width:
+                player.x = grid.width - 1
+            if new_y < 0:
+                player.y = 0
+            if new_y >= grid.height:
+                player.y = grid.height - 1
+
+            in_bounds = 0 <= new_x < grid.width and 0 <= new_y < grid.height
+            index = new_y * grid.width + new_x
+            cell = grid.cells[index] if in_bounds else None
+            if cell == player.color:
+                if player.trail:
+                    grid.fill_enclosed_area(player.color)
+                    self.changes += COLOR_OP.pack(OP_FILL, player.color)
+                    del player.trail[:]
+            else:
+                player.trail.append(index if in_bounds else -1)
+                if in_bounds:
+                    grid.cells[index] = player.color
+                    self.changes += SET_OP.pack(OP_SET, index, player.color)
+            if self.changes or player.grid_position() != old_position:
+                self.dirty = True
 
     def render(self, display: GenericDisplay) -> None:
         self.grid.render(display)
         for player in self.players.values():
             px, py = player.grid_position()
-            color = player.color.brightness(0.5)
-            display.draw(px * 2, py, color)
-            display.draw(px * 2 + 1, py, color)
+            display.draw_span(px * 2, py, 2, HEAD_PALETTE[player.color])
+
+
+def pack_frame(payload: bytearray) -> bytes:
+    return FRAME_HEADER.pack(len(payload)) + payload
 
 
-def parse_command(cmd: str) -> Optional[Key]:
-    mapping = {
-        'UP': Key.UP,
-        'DOWN': Key.DOWN,
-        'LEFT': Key.LEFT,
-        'RIGHT': Key.RIGHT,
-    }
-    return mapping.get(cmd.strip().upper())
+COMMANDS = {
+    b'UP': Key.UP,
+    b'DOWN': Key.DOWN,
+    b'LEFT': Key.LEFT,
+    b'RIGHT': Key.RIGHT,
+    b'\033[A': Key.UP,
+    b'\033[B': Key.DOWN,
+    b'\033[C': Key.RIGHT,
+    b'\033[D': Key.LEFT,
+}
 
 
-def handle_client(
-    conn: socket.socket,
-    addr: tuple[str, int],
+def parse_command(cmd: bytes) -> Optional[Key]:
+    return COMMANDS.get(cmd.strip().upper())
+
+
+async def handle_client(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
     game: Game,
-    player_id: int,
+    clients: dict[int, asyncio.StreamWriter],
+    joining: dict[int, asyncio.StreamWriter],
 ) -> None:
+    addr = writer.get_extra_info('peername')
+    player_id = id(writer)
+    player = Player(
+        x=random.randint(0, game.grid.width - 1),
+        y=random.randint(0, game.grid.height - 1),
+        color=random.randrange(1, len(PALETTE)),
+    )
+    game.add_player(player_id, player)
+    joining[player_id] = writer
     print('[INFO] Client %s connected with id %d' % (str(addr), player_id))
     try:
-        while game.running:
-            ready, _, _ = select.select([conn], [], [], 0.05)
-            if ready:
-                data = conn.recv(1024)
-                if not data:
-                    break
-                command = data.decode().strip()
-                key = parse_command(command)
-                if key:
-                    with game.lock:
-                        if player_id in game.players:
-                            game.players[player_id].handle_key(key)
+        while line := await reader.readline():
+            key = parse_command(line)
+            if key:
+                player.handle_key(key)
     except Exception as e:
         print('[ERROR] Error with client %s: %s' % (str(addr), e), file=sys.stderr)
     finally:
         print('[INFO] Client %s disconnected' % str(addr))
+        clients.pop(player_id, None)
+        joining.pop(player_id, None)
         game.remove_player(player_id)
-        conn.close()
+        writer.close()
 
 
-def game_loop(game: Game, clients: dict[int, socket.socket]) -> None:
-    frame_time = 1.0 / TARGET_FPS
+async def game_loop(
+    game: Game,
+    clients: dict[int, asyncio.StreamWriter],
+    joining: dict[int, asyncio.StreamWriter],
+) -> None:
+    frame_ns = 1_000_000_000 // TARGET_FPS
+    now = time.monotonic_ns
+    update = game.update
+    encode_delta = game.encode_delta
+    last_tick = deadline = now()
     while game.running:
-        start = time.time()
-        game.update(frame_time)
-        data = pickle.dumps(game)
-        remove_ids = []
-        for pid, conn in clients.items():
-            try:
-                conn.sendall(data)
-            except Exception:
-                remove_ids.append(pid)
-        for pid in remove_ids:
-            if pid in clients:
-                del clients[pid]
-        elapsed = time.time() - start
-        time.sleep(max(0, frame_time - elapsed))
+        tick = now()
+        # Capped at a frame: Game.update only paints the cell a player ends
+        # the tick on, so a longer step would leave gaps in trails
+        update(min(tick - last_tick, frame_ns) / 1e9)
+        last_tick = tick
+        if game.dirty:
+            data = pack_frame(encode_delta())
+            for writer in clients.values():
+                if writer.is_closing():
+                    continue
+                # Deltas cannot be skipped, so a client that stopped reading
+                # is dropped instead of buffered for without bound
+                if writer.transport.get_write_buffer_size() > SEND_BUFFER_LIMIT:
+                    writer.transport.abort()
+                    continue
+                writer.write(data)
+        # Snapshots are taken right after this tick's delta went out, so a
+        # new client applies every later delta on top of it exactly once
+        if joining:
+            snapshot = pack_frame(game.encode_snapshot())
+            for writer in joining.values():
+                writer.write(snapshot)
+            clients.update(joining)
+            joining.clear()
+        deadline = max(deadline + frame_ns, now())
+        await asyncio.sleep((deadline - now()) / 1e9)
+
+
+async def serve(game: Game) -> None:
+    clients: dict[int, asyncio.StreamWriter] = {}
+    joining: dict[int, asyncio.StreamWriter] = {}
+    server = await asyncio.start_server(
+        functools.partial(handle_client, game=game, clients=clients, joining=joining),
+        port=12345,
+    )
+    print('[INFO] Server started on port 12345')
+    loop_task = asyncio.create_task(game_loop(game, clients, joining))
+    try:
+        # The server is already accepting; serve_forever() is not used since
+        # on cancellation it waits for every client before this cleanup runs
+        await loop_task
+    finally:
+        game.running = False
+        loop_task.cancel()
+        # wait_closed() waits for every connection, and handlers stay parked
+        # in readline() until their client leaves, so drop them first
+        for writer in (*clients.values(), *joining.values()):
+            writer.transport.abort()
+        server.close()
+        await server.wait_closed()
 
 
 def main() -> None:
@@ -261,47 +479,11 @@ def main() -> None:
     grid_width = term_size.columns // 2
     grid_height = term_size.lines
     game = Game(grid_width, grid_height)
-    clients: dict[int, socket.socket] = {}
-
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind(('', 12345))
-    server.listen()
-    print('[INFO] Server started on port 12345')
-
-    threading.Thread(target=game_loop, args=(game, clients), daemon=True).start()
 
     try:
-        while True:
-            conn, addr = server.accept()
-            player_id = id(conn)
-            color = random.choice(
-                [
-                    Color(0, 0, 1),
-                    Color(0, 1, 0),
-                    Color(0, 1, 1),
-                    Color(1, 0, 0),
-                    Color(1, 0, 1),
-                    Color(1, 1, 0),
-                ]
-            )
-            player = Player(
-                x=random.randint(0, game.grid.width - 1),
-                y=random.randint(0, game.grid.height - 1),
-                color=color,
-            )
-            game.add_player(player_id, player)
-            clients[player_id] = conn
-            threading.Thread(
-                target=handle_client,
-                args=(conn, addr, game, player_id),
-                daemon=True,
-            ).start()
+        asyncio.run(serve(game))
     except KeyboardInterrupt:
         print('[INFO] Server shutting down...')
-    finally:
-        game.running = False
-        server.close()
 
 
 if __name__ == '__main__':